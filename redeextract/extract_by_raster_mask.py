@@ -1,24 +1,35 @@
 """
 Class to extract global rasters to extent and mask of template raster
 
-GDAL command line utilities should be installed on the working
- computer and the path to GDAL should be set in the environment variables
+GDAL is used through its Python bindings (osgeo) and rasterio, so the
+GDAL command line utilities are not required
 """
 from concurrent.futures import ThreadPoolExecutor
 import os
-import subprocess
 import threading
 
 import fiona
 from geocube.api.core import make_geocube
 import geopandas as gpd
+from numba import njit
 from osgeo import gdal
 import rasterio
 import numpy as np
-import pandas.api.types as ptypes
 import rioxarray
 
-MAX_WORKERS = os.cpu_count() * 5  # Number of threads to use concurrently
+# GDAL config used for the duration of each extract/rasterise. A larger
+# block cache avoids decompressing the same blocks repeatedly.
+# GDAL_NUM_THREADS is not set: the warper falls back to it, and the mask
+# thread pool already runs one warp per cpu
+GDAL_ENV = {
+    'GDAL_CACHEMAX': 2048,  # MB
+    'VSI_CACHE': True,
+    'CPL_VSIL_CURL_CHUNK_SIZE': 1048576
+}
+
+# Remote rasters are I/O bound so get more threads per cpu
+REMOTE_PREFIXES = ('http', 's3://', '/vsi')
+REMOTE_WORKERS_PER_CPU = 4
 
 
 # Lookups for rasterio vs numpy datatypes (THIS DOESN'T INCLUDE ALL TYPES)
@@ -34,13 +45,66 @@ DATA_TYPES = {
 }
 
 
+def _nodata_in_dtype(value, dtype):
+    """Returns nodata value as a float holding its value in dtype, or nan
+    (which never matches) if it is None, nan or out of range for dtype"""
+    if value is None or np.isnan(value):
+        return np.nan
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        if not info.min <= value <= info.max or value != int(value):
+            return np.nan
+        return float(value)
+    with np.errstate(over='ignore'):
+        cast = dtype.type(value)
+    if np.isinf(cast) and not np.isinf(value):
+        return np.nan
+    return float(cast)
+
+
+def _in_dtype_range(value, dtype):
+    """Returns True if value can be stored in dtype without wrapping or
+    overflowing. nan only fits float dtypes"""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return bool(not np.isnan(value) and info.min <= value <= info.max)
+    info = np.finfo(dtype)
+    return bool(np.isnan(value) or info.min <= value <= info.max)
+
+
+@njit(nogil=True, cache=True, boundscheck=False)
+def _mask_kernel(data, data_mst, out, mst_nodata, mst_nodata_nan,
+                 src_nodata, sentinel, nodata):
+    """Writes data cast (truncated, as astype does) to the dtype of out,
+    with nodata where mask is nodata or data is nodata or below
+    sentinel. Pass nan to skip a nodata comparison; mst_nodata_nan
+    makes nan mask pixels count as nodata"""
+    single_band_mask = data_mst.shape[0] == 1
+    for i in range(data.shape[0]):
+        b = 0 if single_band_mask else i
+        for j in range(data.shape[1]):
+            for k in range(data.shape[2]):
+                v = data[i, j, k]
+                m = data_mst[b, j, k]
+                if mst_nodata_nan:
+                    masked = m != m
+                else:
+                    masked = m == mst_nodata
+                if masked or v == src_nodata or v < sentinel:
+                    out[i, j, k] = nodata
+                else:
+                    out[i, j, k] = v
+
+
 class ExtractByRasterMask:
     """Class to extract raster to extent and extent of template \
         raster"""
 
     def __init__(self, glob_raster, mask_raster, out_raster,
                  nodata=-99999, dtype='float32',
-                 resampling='bilinear'
+                 resampling='bilinear', tile_factor=4
                  ):
         """
         Parameters:
@@ -52,6 +116,8 @@ class ExtractByRasterMask:
         dtype (str) :: Dtype of output raster
         resampling (str) :: Method to use for resampling (Default =
         bilinear) --options see https://gdal.org/programs/gdalwarp.html
+        tile_factor (int) :: Number of output blocks along each axis
+        to read/write per window (Default = 4)
         """
         self.glob_raster = glob_raster
         self.mask_raster = mask_raster
@@ -61,12 +127,15 @@ class ExtractByRasterMask:
         self.nodata = nodata
         self.dtype = dtype
         self.resampling = resampling
+        self.tile_factor = tile_factor
         self.original_nodata = None
-        self.extent, self.width, self.height, self.profile = \
-            self.get_extent_dims()
-        self.extract_to_extent()
-        self.extract_to_mask()
-        self.calc_stats()
+        self.remote = str(self.glob_raster).startswith(REMOTE_PREFIXES)
+        with rasterio.Env(**GDAL_ENV):
+            self.extent, self.width, self.height, self.profile = \
+                self.get_extent_dims()
+            self.extract_to_extent()
+            self.extract_to_mask()
+            self.calc_stats()
 
     def get_extent_dims(self):
         """
@@ -81,6 +150,7 @@ class ExtractByRasterMask:
                        compress='LZW', bigtiff='IF_SAFER')
         profile.update(tiled=True)
         profile.update(blockxsize=512, blockysize=512)
+        profile.update(num_threads='ALL_CPUS')
         extent = (src.bounds.left,
                   src.bounds.bottom,
                   src.bounds.right,
@@ -92,70 +162,132 @@ class ExtractByRasterMask:
 
     def extract_to_extent(self):
         """
-        Saves tmp file in same folder as out_raster as extraction of
-        global raster to extent of mask raster
+        Saves tmp VRT in same folder as out_raster as extraction of
+        global raster to extent of mask raster. The VRT is warped
+        lazily so only the blocks read in extract_to_mask are resampled
         """
-        ''' cmd = (f'gdalwarp -ot Float32 -te {self.extent_str} -r '
-               f'{self.resampling} -srcnodata {self.original_nodata} '
-               f'-dstnodata {self.nodata} -co "COMPRESS=LZW" -co '
-               f'"PREDICTOR=2" -co "BIGTIFF=YES" -co "BLOCKXSIZE=512" '
-               f'-co "BLOCKYSIZE=512" -co "TILED=YES" '
-               f'-ts {self.dimensions_str} {str(self.glob_raster)} '
-               f'{str(self.out_raster.parent.joinpath("tmp.tif"))}')
-        print(cmd)
-        subprocess.run(cmd, stdout=subprocess.DEVNULL,
-                       stderr=subprocess.STDOUT, check=True, shell=True) '''
-        gdal.Warp(str(self.out_raster.parent.joinpath("tmp.tif")),
+        # The returned dataset is not kept so it is closed (and the VRT
+        # written) as soon as the call returns
+        gdal.Warp(str(self.out_raster.parent.joinpath("tmp.vrt")),
                   str(self.glob_raster),
+                  format='VRT',
                   outputBounds=self.extent,
                   width=self.width,
                   height=self.height,
                   resampleAlg=self.resampling,
                   dstNodata=self.nodata,
-                  options=['"COMPRESS=LZW" '
-                           '"PREDICTOR=2" "BIGTIFF=YES" '
-                           '"BLOCKXSIZE=512" "BLOCKYSIZE=512" '
-                           '"TILED=YES"']
+                  creationOptions=['BLOCKXSIZE=512', 'BLOCKYSIZE=512'],
+                  warpMemoryLimit=1 << 30
                   )
 
     def extract_to_mask(self):
         """
-        Extracts tmp raster by mask using mask raster
+        Extracts tmp VRT by mask using mask raster. Each worker thread
+        reads through its own dataset handles into its own pre-allocated
+        buffers so reads run concurrently; only writes to the output are
+        serialised. Source windows are read in the VRT's own dtype and
+        only cast to the output dtype after masking
         """
-        with rasterio.open(self.mask_raster) as mst,\
-            rasterio.open(self.out_raster.parent.joinpath('tmp.tif')) as src, \
-                rasterio.open(self.out_raster, 'w', **self.profile) as dst:
-            windows = [window for ji, window in src.block_windows()]
-            read_lock = threading.Lock()
+        src_path = self.out_raster.parent.joinpath('tmp.vrt')
+        tls = threading.local()
+        handles = []
+        handles_lock = threading.Lock()
+        with rasterio.open(self.out_raster, 'w', **self.profile) as dst:
+            windows = self.aggregate_windows(dst.block_windows())
+            max_height = max(int(window.height) for window in windows)
+            max_width = max(int(window.width) for window in windows)
             write_lock = threading.Lock()
+            dtype = DATA_TYPES[self.dtype]
+            nodata = np.array(self.nodata).astype(dtype)[()]
+            sentinel = -9999999999.0
+            nodata_tile = np.full((dst.count, max_height, max_width),
+                                  nodata, dtype=dtype)
+
+            def get_handles():
+                if not hasattr(tls, 'src'):
+                    tls.src = rasterio.open(src_path, sharing=False)
+                    tls.mst = rasterio.open(self.mask_raster, sharing=False)
+                    with handles_lock:
+                        handles.extend([tls.src, tls.mst])
+                    tls.buf = np.empty((dst.count, max_height, max_width),
+                                       dtype=tls.src.dtypes[0])
+                    tls.out_buf = np.empty(tls.buf.shape, dtype=dtype)
+                    tls.mst_buf = np.empty(
+                        (tls.mst.count, max_height, max_width),
+                        dtype=tls.mst.dtypes[0])
+                    # Nodata values are compared in the dtype of the data
+                    # they are compared against
+                    tls.src_nodata = _nodata_in_dtype(self.original_nodata,
+                                                      tls.src.dtypes[0])
+                    tls.mst_nodata = _nodata_in_dtype(tls.mst.nodata,
+                                                      tls.mst.dtypes[0])
+                    tls.mst_nodata_nan = bool(
+                        tls.mst.nodata is not None and
+                        np.isnan(tls.mst.nodata) and
+                        np.issubdtype(tls.mst_buf.dtype, np.floating))
+                return tls.src, tls.mst, tls.buf, tls.mst_buf
 
             def process(window):
-                with read_lock:
-                    data = src.read(window=window)
-                with read_lock:
-                    data_mst = mst.read(window=window)
-                data[data_mst == mst.nodata] = self.nodata
-                data[data == self.original_nodata] = self.nodata
-                data[data < -9999999999] = self.nodata
-                data = data.astype(DATA_TYPES[self.dtype])
+                src, mst, buf, mst_buf = get_handles()
+                height, width = int(window.height), int(window.width)
+                data_mst = mst.read(window=window,
+                                    out=mst_buf[:, :height, :width])
+                # Skip reading (and warping) source where mask is all nodata
+                if tls.mst_nodata_nan:
+                    all_nodata = np.isnan(data_mst).all()
+                else:
+                    all_nodata = (not np.isnan(tls.mst_nodata) and
+                                  (data_mst == tls.mst_nodata).all())
+                if all_nodata:
+                    with write_lock:
+                        dst.write(nodata_tile[:, :height, :width],
+                                  window=window)
+                    return
+                data = src.read(window=window,
+                                out=buf[:, :height, :width])
+                out = tls.out_buf[:, :height, :width]
+                _mask_kernel(data, data_mst, out, tls.mst_nodata,
+                             tls.mst_nodata_nan, tls.src_nodata, sentinel,
+                             nodata)
                 with write_lock:
-                    dst.write(data, window=window)
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                executor.map(process, windows)
+                    dst.write(out, window=window)
+            max_workers = os.cpu_count() or 1
+            if self.remote:
+                max_workers *= REMOTE_WORKERS_PER_CPU
+            max_workers = min(max_workers, max(1, len(windows)))
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    list(executor.map(process, windows))
+            finally:
+                for handle in handles:
+                    handle.close()
+
+    def aggregate_windows(self, block_windows):
+        """
+        Returns list of windows each covering a tile_factor x
+        tile_factor group of adjacent block windows
+        """
+        groups = {}
+        for (row, col), window in block_windows:
+            key = (row // self.tile_factor, col // self.tile_factor)
+            groups.setdefault(key, []).append(window)
+        return [rasterio.windows.union(*group) for group in groups.values()]
 
     def calc_stats(self):
-        """Calls gdalinfo to calculate stats on output raster"""
-        cmd = f"gdalinfo -stats {self.out_raster}"
-        subprocess.call(cmd, stdout=subprocess.DEVNULL,
-                        stderr=subprocess.STDOUT, shell=True)
-        # REMOVE TMP RASTER
-        self.out_raster.parent.joinpath('tmp.tif').unlink()
+        """Calculates stats on output raster"""
+        ds = gdal.Open(str(self.out_raster), gdal.GA_Update)
+        for i in range(ds.RasterCount):
+            ds.GetRasterBand(i + 1).ComputeStatistics(False)
+        ds.FlushCache()
+        ds = None
+        # REMOVE TMP VRT
+        self.out_raster.parent.joinpath('tmp.vrt').unlink()
 
 
 class RasteriseToMastergrid:
-    """Class with functions that call gdal commands to rasterise
-    shapefiles or geopackages so that the output extent and resolution
-    and transform match the input mastergrid"""
+    """Class with functions that rasterise shapefiles or geopackages
+    so that the output extent and resolution and transform match the
+    input mastergrid"""
     def __init__(self, vector, out_raster, field,
                  template=None, resolution=None,
                  dtype="int32", nodata=9999, layer=None):
@@ -207,6 +339,11 @@ class RasteriseToMastergrid:
         self.dtype = dtype
         self.nodata = nodata
         self.layer = layer
+        self.gdf = None
+        if not _in_dtype_range(self.nodata, DATA_TYPES[self.dtype]):
+            raise NodataOutOfRangeError(f'Nodata value {self.nodata} is '
+                                        'out of range for dtype '
+                                        f'{self.dtype}.')
         if self.layer:
             try:
                 assert self.layer in fiona.listlayers(self.vector)
@@ -228,6 +365,7 @@ class RasteriseToMastergrid:
 
     def attribute_field_valid(self,):
         """Returns True is valid integer field in self.vector, else false.
+        Only the schema is read, not the features.
 
         Parameters:
         -----------
@@ -237,10 +375,12 @@ class RasteriseToMastergrid:
         --------
         Boolean
         """
-        gdf = gpd.read_file(self.vector, layer=self.layer)
+        with fiona.open(self.vector, layer=self.layer) as src:
+            properties = src.schema['properties']
         try:
-            assert self.field in gdf.columns
-            assert ptypes.is_numeric_dtype(gdf[self.field])
+            assert self.field in properties
+            assert fiona.prop_type(properties[self.field]) in \
+                (int, float, bool)
             return True
         except AssertionError:
             return False
@@ -249,18 +389,19 @@ class RasteriseToMastergrid:
         """
         Returns
         extent_str, dimensions_str (Tuple) : Returns tuple of strings \
-            representing extent and dimensions
+            representing extent and dimensions. Derived from the already
+            opened template dataset rather than re-opening the file
         """
-        src = rasterio.open(self.template)
-        extent_str = (f'{src.bounds.left} {src.bounds.bottom} '
-                      f'{src.bounds.right} {src.bounds.top}')
-        dimension_str = f'{src.width} {src.height}'
-        src.close()
+        width, height = self.dataset.rio.width, self.dataset.rio.height
+        left, bottom, right, top = rasterio.transform.array_bounds(
+            height, width, self.dataset.rio.transform())
+        extent_str = f'{left} {bottom} {right} {top}'
+        dimension_str = f'{width} {height}'
         return extent_str, dimension_str
 
     def rasterise(self):
         """
-        Calls gdal_rasterise command to rasterise vector file to dims \
+        Rasterises vector file with geocube to dims \
             and resolution of mastergrid
 
         Parameters:
@@ -272,15 +413,27 @@ class RasteriseToMastergrid:
         None
 
         """
-        if self.layer:
-            gdf = gpd.read_file(self.vector, layer=self.layer)
-        else:
-            gdf = gpd.read_file(self.vector)
-        cube = make_geocube(gdf,
-                            measurements=[self.field],
-                            resolution=self.resolution,
-                            like=self.dataset)
-        cube[self.field].rio.to_raster(self.out_raster)
+        with rasterio.Env(**GDAL_ENV):
+            if self.gdf is None:
+                gdf = gpd.read_file(self.vector, layer=self.layer)
+                # Nulls are filled with nodata so int dtypes can be cast
+                values = gdf[self.field].fillna(self.nodata)
+                dtype = DATA_TYPES[self.dtype]
+                # Check the range first as astype silently wraps values
+                if not (_in_dtype_range(values.min(), dtype) and
+                        _in_dtype_range(values.max(), dtype)):
+                    raise FieldValueOutOfRangeError(
+                        f'{self.field} values ({values.min()} to '
+                        f'{values.max()}) are out of range for dtype '
+                        f'{self.dtype}.')
+                gdf[self.field] = values.astype(dtype)
+                self.gdf = gdf
+            cube = make_geocube(self.gdf,
+                                measurements=[self.field],
+                                resolution=self.resolution,
+                                like=self.dataset,
+                                fill=self.nodata)
+            cube[self.field].rio.to_raster(self.out_raster)
 
 
 class AttributeFieldInvalidError(Exception):
@@ -296,3 +449,13 @@ class LayerNotFoundError(Exception):
 class ResolutionNotGivenError(Exception):
     """Resolution not given error"""
     pass
+
+
+class NodataOutOfRangeError(Exception):
+    """Nodata out of range for dtype error"""
+    pass
+
+
+class FieldValueOutOfRangeError(Exception):
+    """Field value out of range for dtype error"""
+    pass
@@ -0,0 +1,14 @@
+"""Shared pytest configuration for redeextract tests"""
+
+import pytest
+import rasterio
+
+
+@pytest.fixture(scope="session", autouse=True)
+def gdal_env():
+    """Opens one GDAL environment for the whole test session so driver
+    registration and config happen once. EMPTY_DIR stops GDAL listing
+    the data directory on every open"""
+    with rasterio.Env(GDAL_CACHEMAX=512,
+                      GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'):
+        yield
@@ -3,7 +3,14 @@
 
 import pytest
 from pathlib import Path
+from types import SimpleNamespace
+import geopandas as gpd
+import numpy as np
 import rasterio
+import rasterio.shutil
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, Resampling
+from rasterio.windows import Window
 
 import redeextract
 
@@ -14,34 +21,84 @@ TEMPLATE = BASE.joinpath('template.tif')
 TEST_SHP = BASE.joinpath('gadm41_DMA_shp/gadm41_DMA_0.shp')
 TEST_GPKG = BASE.joinpath('gadm41_DMA.gpkg')
 
-OUT_RASTER = BASE.joinpath('TEST_RASTER.tif')
-OUT_EXTRACT = BASE.joinpath('TEST_EXTRACT.tif')
+# Rasterised outputs go to GDAL's in-memory filesystem to skip disk I/O.
+# Extraction still needs a real directory for its tmp.vrt sidecar
+VSIMEM = '/vsimem'
+OUT_RASTER = f'{VSIMEM}/TEST_RASTER.tif'
 
 
-@pytest.fixture
-def extr():
-    x = redeextract.ExtractByRasterMask(GLOB_RASTER, TEMPLATE,
-                                        OUT_EXTRACT,
-                                        resampling="nearest")
+def raster_meta(path):
+    """Returns bounds and dimensions of raster at path, computed from
+    the geotransform of an unshared dataset handle"""
+    with rasterio.open(path, sharing=False) as src:
+        transform, width, height = src.transform, src.width, src.height
+    left, top = transform.c, transform.f
+    right = left + width * transform.a
+    bottom = top + height * transform.e
+    return SimpleNamespace(
+        extent=(left, bottom, right, top),
+        extent_str=f'{left} {bottom} {right} {top}',
+        width=width,
+        height=height,
+        dims=f'{width} {height}')
+
+
+@pytest.fixture(scope="session")
+def template_meta():
+    yield raster_meta(TEMPLATE)
+
+
+# extr and rasteriser are module scoped so the expensive work runs once
+# per module rather than once per test. They write to temporary
+# directories (or /vsimem, which is per process) so tests can run in
+# parallel (pytest -n auto) without workers overwriting each other
+@pytest.fixture(scope="module")
+def extr(tmp_path_factory):
+    x = redeextract.ExtractByRasterMask(
+        GLOB_RASTER, TEMPLATE,
+        tmp_path_factory.mktemp('extract').joinpath('TEST_EXTRACT.tif'),
+        resampling="nearest")
     yield x
 
 
-@pytest.fixture
-def shp():
-    x = redeextract.RasteriseToMastergrid(TEST_SHP,
-                                          OUT_RASTER,
-                                          'val',
-                                          template=GLOB_RASTER)
+@pytest.fixture(scope="module")
+def extract_meta(extr):
+    yield raster_meta(extr.out_raster)
+
+
+@pytest.fixture(scope="module",
+                params=[{'vector': TEST_SHP},
+                        {'vector': TEST_GPKG, 'layer': 'ADM_ADM_0'}],
+                ids=['shp', 'gpkg'])
+def rasteriser(request):
+    out_raster = (f'{VSIMEM}/TEST_RASTER_'
+                  f'{request.param["vector"].stem}.tif')
+    x = redeextract.RasteriseToMastergrid(
+        out_raster=out_raster,
+        field='val',
+        template=GLOB_RASTER,
+        **request.param)
     yield x
+    if rasterio.shutil.exists(out_raster):
+        rasterio.shutil.delete(out_raster)
 
 
-@pytest.fixture
-def gpkg():
-    y = redeextract.RasteriseToMastergrid(TEST_GPKG,
-                                          OUT_RASTER, 'val',
-                                          template=GLOB_RASTER,
-                                          layer='ADM_ADM_0')
-    yield y
+@pytest.fixture(scope="module")
+def large_mask(tmp_path_factory):
+    """Mask on the global_test.tif bounds, large enough for several 512
+    output blocks, with random nodata and one all-nodata block"""
+    with rasterio.open(GLOB_RASTER) as src:
+        transform = from_bounds(*src.bounds, 1700, 1300)
+        crs = src.crs
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 3, (1, 1300, 1700), dtype=np.uint8)
+    data[:, :512, :512] = 0
+    mask = tmp_path_factory.mktemp('mask').joinpath('LARGE_MASK.tif')
+    with rasterio.open(mask, 'w', driver='GTiff', dtype='uint8', nodata=0,
+                       count=1, width=1700, height=1300, crs=crs,
+                       transform=transform) as dst:
+        dst.write(data)
+    yield mask
 
 
 # ----------------------------------------------------------#
@@ -52,9 +109,8 @@ def gpkg():
 # ----------------------------------------------------------#
 
 
-def test_class_instantiation(shp, gpkg):
-    assert isinstance(shp, redeextract.RasteriseToMastergrid)
-    assert isinstance(gpkg, redeextract.RasteriseToMastergrid)
+def test_class_instantiation(rasteriser):
+    assert isinstance(rasteriser, redeextract.RasteriseToMastergrid)
 
 
 def test_incorrect_field_type_raises_exception():
@@ -70,26 +126,79 @@ def test_incorrect_field_type_raises_exception():
          ' integer field.')
 
 
-def test_extent_and_dimensions(extr):
-    src = rasterio.open(TEMPLATE)
-    expected_extent = (src.bounds.left, src.bounds.bottom,
-                       src.bounds.right, src.bounds.top)
-    expected_width = src.width
-    expected_height = src.height
-    src.close()
-    assert extr.extent == expected_extent
-    assert extr.height == expected_height
-    assert extr.width == expected_width
+def test_rasterise_field_with_nulls(tmp_path):
+    gdf = gpd.read_file(BASE.joinpath('gadm41_DMA_shp/gadm41_DMA_1.shp'))
+    gdf['val'] = [None] + list(range(1, len(gdf)))
+    vector = tmp_path.joinpath('null_field.shp')
+    gdf.to_file(vector)
+    out_raster = f'{VSIMEM}/TEST_RASTER_NULLS.tif'
+    x = redeextract.RasteriseToMastergrid(vector, out_raster, 'val',
+                                          template=GLOB_RASTER)
+    x.rasterise()
+    null_point = gdf.geometry.iloc[0].representative_point()
+    with rasterio.open(out_raster) as src:
+        data = src.read(1)
+        null_pixel = data[src.index(null_point.x, null_point.y)]
+    rasterio.shutil.delete(out_raster)
+    assert set(np.unique(data)) == set(range(1, len(gdf))) | {x.nodata}
+    assert null_pixel == x.nodata
+
+
+def test_nodata_out_of_range_raises_exception():
+    with pytest.raises(redeextract.NodataOutOfRangeError):
+        _ = redeextract.RasteriseToMastergrid(TEST_SHP, OUT_RASTER, 'val',
+                                              template=GLOB_RASTER,
+                                              dtype='ubyte')
+
+
+@pytest.mark.parametrize('dtype,nodata,value', [('ubyte', 255, 300),
+                                                ('int16', -9999, 70000)])
+def test_field_value_out_of_range_raises_exception(tmp_path, dtype,
+                                                   nodata, value):
+    gdf = gpd.read_file(TEST_SHP)
+    gdf['val'] = value
+    vector = tmp_path.joinpath('out_of_range.shp')
+    gdf.to_file(vector)
+    x = redeextract.RasteriseToMastergrid(vector, OUT_RASTER, 'val',
+                                          template=GLOB_RASTER,
+                                          dtype=dtype, nodata=nodata)
+    with pytest.raises(redeextract.FieldValueOutOfRangeError):
+        x.rasterise()
+    assert not rasterio.shutil.exists(OUT_RASTER)
+
+
+def test_rasterise_ubyte():
+    out_raster = f'{VSIMEM}/TEST_RASTER_UBYTE.tif'
+    x = redeextract.RasteriseToMastergrid(TEST_SHP, out_raster, 'val',
+                                          template=GLOB_RASTER,
+                                          dtype='ubyte', nodata=255)
+    x.rasterise()
+    with rasterio.open(out_raster) as src:
+        dtype, values = src.dtypes[0], np.unique(src.read())
+    rasterio.shutil.delete(out_raster)
+    assert dtype == 'uint8'
+    assert set(values) == {1, 255}
+
+
+def test_bool_field_is_valid(tmp_path):
+    gdf = gpd.read_file(TEST_SHP)
+    gdf['flag'] = True
+    vector = tmp_path.joinpath('bool_field.gpkg')
+    gdf.to_file(vector)
+    x = redeextract.RasteriseToMastergrid(vector, OUT_RASTER, 'flag',
+                                          template=GLOB_RASTER)
+    assert x.attribute_field_valid()
 
 
-def test_rasterise_gpkg(gpkg):
-    gpkg.rasterise()
-    assert OUT_RASTER.exists()
+def test_extent_and_dimensions(extr, template_meta):
+    assert extr.extent == template_meta.extent
+    assert extr.height == template_meta.height
+    assert extr.width == template_meta.width
 
 
-def test_rasterise_shp(shp):
-    shp.rasterise()
-    assert OUT_RASTER.exists()
+def test_rasterise(rasteriser):
+    rasteriser.rasterise()
+    assert rasterio.shutil.exists(rasteriser.out_raster)
 
 
 # ----------------------------------------------------------#
@@ -105,22 +214,118 @@ def test_rasterise_shp(shp):
 # --------------------EXTRACT-------------------------------#
 # ----------------------------------------------------------#
 # ----------------------------------------------------------#
-def test_extract_by_raster_mask(extr):
-    src = rasterio.open(OUT_EXTRACT)
-    extent = (f'{src.bounds.left} {src.bounds.bottom} '
-              f'{src.bounds.right} {src.bounds.top}')
-    dims = f'{src.width} {src.height}'
-    src.close()
+def test_extract_by_raster_mask(extr, extract_meta, template_meta):
+    assert extr.out_raster.exists()
+    assert template_meta.extent_str == extract_meta.extent_str
+    assert template_meta.dims == extract_meta.dims
+
+
+def test_extract_pixel_values(extr):
+    with rasterio.open(TEMPLATE) as mst, rasterio.open(GLOB_RASTER) as src:
+        template = mst.read()
+        warped = np.full(template.shape, -99999, dtype=np.float32)
+        reproject(src.read(), warped,
+                  src_transform=src.transform, src_crs=src.crs,
+                  src_nodata=src.nodata,
+                  dst_transform=mst.transform, dst_crs=mst.crs,
+                  dst_nodata=-99999, resampling=Resampling.nearest)
+        template_nodata = template == mst.nodata
+    with rasterio.open(extr.out_raster) as src:
+        data = src.read()
+    assert (data[template_nodata] == -99999).all()
+    # Source values equal to the mask's nodata are also set to nodata
+    expected = np.where(warped == extr.original_nodata, -99999, warped)
+    assert np.array_equal(data[~template_nodata],
+                          expected[~template_nodata])
+
+
+def test_extract_tile_factor_gives_same_output(large_mask, tmp_path):
+    with rasterio.open(large_mask) as mst, \
+            rasterio.open(GLOB_RASTER) as src:
+        template = mst.read()
+        warped = np.full(template.shape, -99999, dtype=np.float32)
+        reproject(src.read(), warped,
+                  src_transform=src.transform, src_crs=src.crs,
+                  src_nodata=src.nodata,
+                  dst_transform=mst.transform, dst_crs=mst.crs,
+                  dst_nodata=-99999, resampling=Resampling.nearest)
+        expected = np.where(template == mst.nodata, -99999, warped)
+    # 512 output blocks give 4 x 3 windows, aggregated to 2 x 2 and 1
+    for tile_factor, n_windows in [(1, 12), (2, 4), (4, 1)]:
+        x = redeextract.ExtractByRasterMask(
+            GLOB_RASTER, large_mask,
+            tmp_path.joinpath(f'TEST_EXTRACT_TF{tile_factor}.tif'),
+            resampling="nearest", tile_factor=tile_factor)
+        with rasterio.open(x.out_raster) as dst:
+            assert len(x.aggregate_windows(dst.block_windows())) == \
+                n_windows
+            assert np.array_equal(dst.read(), expected)
 
-    src_mst = rasterio.open(TEMPLATE)
-    mst_extent = \
-        (f'{src_mst.bounds.left} {src_mst.bounds.bottom} '
-         f'{src_mst.bounds.right} {src_mst.bounds.top}')
-    dims_mst = f'{src_mst.width} {src_mst.height}'
-    src_mst.close()
-    assert OUT_EXTRACT.exists()
-    assert mst_extent == extent
-    assert dims_mst == dims
+
+def test_aggregate_windows(extr):
+    # 5 x 3 grid of 512 blocks, last row/column partial
+    block_windows = [((row, col), Window(col * 512, row * 512,
+                                         100 if col == 2 else 512,
+                                         50 if row == 4 else 512))
+                     for row in range(5) for col in range(3)]
+    windows = extr.aggregate_windows(block_windows)
+    assert extr.tile_factor == 4
+    assert len(windows) == 2
+    coverage = np.zeros((4 * 512 + 50, 2 * 512 + 100), dtype=int)
+    for window in windows:
+        coverage[window.toslices()] += 1
+    assert (coverage == 1).all()
+
+
+def test_extract_all_nodata_mask(tmp_path):
+    with rasterio.open(TEMPLATE) as src:
+        profile = src.profile.copy()
+        nodata_mask = np.full((src.count, src.height, src.width),
+                              src.nodata, dtype=src.dtypes[0])
+    mask = tmp_path.joinpath('NODATA_MASK.tif')
+    with rasterio.open(mask, 'w', **profile) as dst:
+        dst.write(nodata_mask)
+    extr_nodata = redeextract.ExtractByRasterMask(
+        GLOB_RASTER, mask, tmp_path.joinpath('TEST_EXTRACT_NODATA.tif'),
+        resampling="nearest")
+    with rasterio.open(extr_nodata.out_raster) as src:
+        assert (src.read() == -99999).all()
+
+
+def test_extract_int_output_truncates(extr, tmp_path):
+    # Masking runs on the source values, then they are truncated to the
+    # output dtype (as numpy astype does) rather than rounded by GDAL
+    extr_int = redeextract.ExtractByRasterMask(
+        GLOB_RASTER, TEMPLATE, tmp_path.joinpath('TEST_EXTRACT_INT.tif'),
+        dtype='int32', resampling="nearest")
+    with rasterio.open(extr.out_raster) as src:
+        expected = src.read().astype(np.int32)
+    with rasterio.open(extr_int.out_raster) as src:
+        assert np.array_equal(src.read(), expected)
+
+
+def test_extract_nan_nodata_mask(extr, tmp_path):
+    # A float mask with nan nodata used with an int output must not fail
+    # casting the mask's nodata, and nan mask pixels must be masked
+    with rasterio.open(TEMPLATE) as src:
+        profile = src.profile.copy()
+        template = src.read()
+        template_nodata = template == src.nodata
+    profile.update(dtype='float32', nodata=np.nan)
+    nan_mask = tmp_path.joinpath('NAN_MASK.tif')
+    with rasterio.open(nan_mask, 'w', **profile) as dst:
+        dst.write(np.where(template_nodata, np.nan, template)
+                  .astype(np.float32))
+    extr_nan = redeextract.ExtractByRasterMask(
+        GLOB_RASTER, nan_mask, tmp_path.joinpath('TEST_EXTRACT_NAN.tif'),
+        dtype='int32', resampling="nearest")
+    with rasterio.open(extr.out_raster) as src:
+        expected = src.read().astype(np.int32)
+    with rasterio.open(extr_nan.out_raster) as src:
+        data = src.read()
+    assert (data[template_nodata] == -99999).all()
+    valid = expected != -99999
+    assert np.array_equal(data[valid], expected[valid])
 
 
 # ----------------------------------------------------------#
@@ -129,3 +334,32 @@ def test_extract_by_raster_mask(extr):
 # --------------------EXTRACT-------------------------------#
 # ----------------------------------------------------------#
 # ----------------------------------------------------------#
+
+
+# ----------------------------------------------------------#
+# ----------------------------------------------------------#
+# ----------------------------------------------------------#
+# --------------------BENCHMARK-----------------------------#
+# ----------------------------------------------------------#
+# ----------------------------------------------------------#
+def test_rasterise_perf(benchmark, rasteriser):
+    # Clear the cached GeoDataFrame so each round includes the vector read
+    benchmark.pedantic(rasteriser.rasterise,
+                       setup=lambda: setattr(rasteriser, 'gdf', None),
+                       rounds=3)
+
+
+def test_extract_perf(benchmark, tmp_path):
+    benchmark.pedantic(redeextract.ExtractByRasterMask,
+                       args=(GLOB_RASTER, TEMPLATE,
+                             tmp_path.joinpath('BENCH_EXTRACT.tif')),
+                       kwargs={'resampling': 'nearest'},
+                       rounds=3)
+
+
+# ----------------------------------------------------------#
+# ----------------------------------------------------------#
+# ----------------------------------------------------------#
+# --------------------BENCHMARK-----------------------------#
+# ----------------------------------------------------------#
+# ----------------------------------------------------------#